@@ -3,61 +3,81 @@
 Add PE base relocations to UEFI EFI file
 This converts ELF dynamic relocations to PE .reloc format
 """
+import mmap
+import shutil
 import struct
 import sys
 
-def add_relocs(elf_file, pe_file):
+# Precompiled little-endian ELF64 field layouts
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
+_DYN = struct.Struct('<QQ')  # Elf64_Dyn: d_tag, d_val
+
+def add_relocs(elf_file, pe_file, parse_elf=False):
     """Read ELF, extract relocations, add to PE"""
-    # For now, create an empty but valid .reloc section
+    # For now the PE is written unchanged; no .reloc section is generated yet
     # This allows UEFI to load the file even if not perfectly relocated
 
-    with open(elf_file, 'rb') as f:
-        data = bytearray(f.read())
+    if parse_elf:
+        # Relocation discovery for the planned .reloc writer
+        with open(elf_file, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as data:
+            rela_offset, rela_size = parse_dynamic(data)
+        if rela_offset is not None:
+            print(f"  DT_RELA at {rela_offset:#x}, {rela_size or 0} bytes")
+
+    # Output is currently a byte-for-byte copy; let the OS do it
+    shutil.copyfile(elf_file, pe_file)
+
+    print(f"Processed {elf_file} -> {pe_file}")
+    return 0
+
+def parse_dynamic(data):
+    """Return (DT_RELA, DT_RELASZ) from the ELF dynamic section, None if absent
+
+    data should be a memoryview so the dynamic section slice is zero-copy.
+    """
+    rela_offset = rela_size = None
 
     # Parse ELF header to find dynamic relocations
     # ELF64 header is at offset 0
-    e_phoff = struct.unpack('<Q', data[32:40])[0]  # Program header offset
-    e_phentsize = struct.unpack('<H', data[54:56])[0]  # Program header size
-    e_phnum = struct.unpack('<H', data[56:58])[0]  # Number of program headers
+    e_phoff = _U64.unpack_from(data, 32)[0]  # Program header offset
+    e_phentsize = _U16.unpack_from(data, 54)[0]  # Program header size
+    e_phnum = _U16.unpack_from(data, 56)[0]  # Number of program headers
 
     # Find dynamic segment
-    relocs = []
     for i in range(e_phnum):
         ph_offset = e_phoff + i * e_phentsize
-        p_type = struct.unpack('<I', data[ph_offset:ph_offset+4])[0]
+        p_type = _U32.unpack_from(data, ph_offset)[0]
 
         if p_type == 2:  # PT_DYNAMIC
-            p_offset = struct.unpack('<Q', data[ph_offset+8:ph_offset+16])[0]
-            p_filesz = struct.unpack('<Q', data[ph_offset+32:ph_offset+40])[0]
+            p_offset = _U64.unpack_from(data, ph_offset + 8)[0]
+            p_filesz = _U64.unpack_from(data, ph_offset + 32)[0]
 
-            # Parse dynamic section for RELA
-            dyn_offset = p_offset
-            while dyn_offset < p_offset + p_filesz:
-                d_tag = struct.unpack('<Q', data[int(dyn_offset):int(dyn_offset+8)])[0]
-                d_val = struct.unpack('<Q', data[int(dyn_offset+8):int(dyn_offset+16)])[0]
+            # Parse dynamic section for RELA (whole Elf64_Dyn entries only)
+            dyn_end = p_offset + p_filesz - p_filesz % _DYN.size
+            # Release the view before returning so the mmap can be closed
+            with data[p_offset:dyn_end] as dyn:
+                for d_tag, d_val in _DYN.iter_unpack(dyn):
+                    if d_tag == 7:  # DT_RELA
+                        rela_offset = d_val
+                    elif d_tag == 8:  # DT_RELASZ
+                        rela_size = d_val
+                    elif d_tag == 0:  # DT_NULL
+                        break
 
-                if d_tag == 7:  # DT_RELA
-                    rela_offset = d_val
-                elif d_tag == 8:  # DT_RELASZ
-                    rela_size = d_val
-                elif d_tag == 0:  # DT_NULL
-                    break
-
-                dyn_offset += 16
-
-    # For simplicity, create minimal valid .reloc section
-    # Even empty, it signals to UEFI that relocations are handled
-    reloc_data = b'\x00' * 12  # Minimal block header
-
-    with open(pe_file, 'wb') as f:
-        f.write(data)
-
-    print(f"Processed {elf_file} -> {pe_file}")
-    return 0
+    return rela_offset, rela_size
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: add_pe_relocs.py <input.so> <output.efi>")
+    args = sys.argv[1:]
+    parse_elf = '--parse-elf' in args
+    if parse_elf:
+        args.remove('--parse-elf')
+
+    if len(args) != 2:
+        print("Usage: add_pe_relocs.py [--parse-elf] <input.so> <output.efi>")
         sys.exit(1)
 
-    sys.exit(add_relocs(sys.argv[1], sys.argv[2]))
+    sys.exit(add_relocs(args[0], args[1], parse_elf))
@@ -7,37 +7,275 @@ Simple package installation and management tool
 import os
 import sys
 import json
-import shutil
-import tarfile
-import zipfile
+import stat
+import time
+import sqlite3
+import posixpath
 import argparse
+import contextlib
 from pathlib import Path
 
-PACKAGE_DB = "/var/lib/scpkg/packages.json"
-PACKAGE_CACHE = "/var/cache/scpkg"
+PACKAGE_DB = "/var/lib/scpkg/packages.db"
 INSTALL_PREFIX = "/usr/local"
 
+# Install destinations packages may never write under
+PROTECTED_PREFIXES = ("/bin/", "/boot/", "/sbin/", "/etc/")
+
+# Buffer size for copying package contents into place
+COPY_BUFSIZE = 2 << 20
+
+# Database written by older releases, imported once on first open
+LEGACY_PACKAGE_DB = "packages.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    version TEXT,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS package_files (
+    pkg TEXT,
+    path TEXT,
+    PRIMARY KEY (pkg, path)
+);
+"""
+
+# Trigram FTS5 index over packages, kept in sync by triggers
+_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS package_search USING fts5(
+    name, description, content='packages', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS packages_ai AFTER INSERT ON packages BEGIN
+    INSERT INTO package_search (rowid, name, description)
+    VALUES (new.rowid, new.name, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS packages_ad AFTER DELETE ON packages BEGIN
+    INSERT INTO package_search (package_search, rowid, name, description)
+    VALUES ('delete', old.rowid, old.name, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS packages_au AFTER UPDATE ON packages BEGIN
+    INSERT INTO package_search (package_search, rowid, name, description)
+    VALUES ('delete', old.rowid, old.name, old.description);
+    INSERT INTO package_search (rowid, name, description)
+    VALUES (new.rowid, new.name, new.description);
+END;
+"""
+
+def _copy_stream(src, dst):
+    """Copy file object src to dst, via sendfile when both are plain files"""
+    try:
+        in_fd, out_fd = src.fileno(), dst.fileno()
+    except (AttributeError, OSError):
+        in_fd = None
+    
+    if in_fd is not None and hasattr(os, "sendfile"):
+        offset = 0
+        try:
+            while True:
+                sent = os.sendfile(out_fd, in_fd, offset, COPY_BUFSIZE)
+                if not sent:
+                    return
+                offset += sent
+        except OSError:
+            # Nothing written yet: fall back to a userspace copy
+            if offset:
+                raise
+    
+    from shutil import copyfileobj
+    copyfileobj(src, dst, COPY_BUFSIZE)
+
+def _tar_entries(members):
+    """Map tar member names to (member, mode, mtime) for install_entries
+    
+    Hard and symbolic links resolve to the regular file they point at, so a
+    copy of the target is installed, as extracting and copying the tree did.
+    """
+    by_name = {posixpath.normpath(member.name): member for member in members}
+    entries = {}
+    for member in members:
+        target = member
+        # Bounded so symlink loops terminate
+        for _ in range(32):
+            if target.issym():
+                link = posixpath.join(posixpath.dirname(posixpath.normpath(target.name)),
+                                      target.linkname)
+            elif target.islnk():
+                link = target.linkname
+            else:
+                break
+            target = by_name.get(posixpath.normpath(link))
+            if target is None:
+                break
+        
+        if target is not None and target.isfile():
+            entries[member.name] = (target, target.mode, target.mtime)
+        elif member.issym() or member.islnk():
+            print(f"Warning: Skipping link with no file in package: "
+                  f"{member.name} -> {member.linkname}")
+    return entries
+
+def _zip_entries(zip_ref):
+    """Map zip member names to (info, mode, mtime) for install_entries
+    
+    Symlink members (as written by zip -y) resolve to the regular file they
+    point at. Unix modes are only kept for regular files.
+    """
+    infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+    by_name = {posixpath.normpath(info.filename): info for info in infos}
+    entries = {}
+    for info in infos:
+        target = info
+        # Bounded so symlink loops terminate
+        for _ in range(32):
+            if not stat.S_ISLNK(target.external_attr >> 16):
+                break
+            link = os.fsdecode(zip_ref.read(target))
+            link = posixpath.join(posixpath.dirname(posixpath.normpath(target.filename)), link)
+            target = by_name.get(posixpath.normpath(link))
+            if target is None:
+                break
+        
+        if target is None or stat.S_ISLNK(target.external_attr >> 16):
+            print(f"Warning: Skipping link with no file in package: {info.filename}")
+            continue
+        mode = target.external_attr >> 16
+        # Zip timestamps are local time
+        entries[info.filename] = (target, mode if stat.S_ISREG(mode) else 0,
+                                  time.mktime(target.date_time + (0, 0, -1)))
+    return entries
+
 class PackageManager:
-    def __init__(self):
+    def __init__(self, writable=True):
         self.db_path = Path(PACKAGE_DB)
-        self.cache_path = Path(PACKAGE_CACHE)
-        self.packages = self.load_db()
+        self.db = self.open_db() if writable else self.open_db_readonly()
+        self.in_batch = False
     
-    def load_db(self):
-        """Load package database"""
-        if self.db_path.exists():
-            try:
-                with open(self.db_path) as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-        return {}
-    
-    def save_db(self):
-        """Save package database"""
+    def open_db_readonly(self):
+        """Open package database for queries only; never writes to disk"""
+        if not self.db_path.exists():
+            # Nothing installed yet (or only an unmigrated packages.json)
+            db = sqlite3.connect(":memory:")
+            db.executescript(_SCHEMA)
+            self.has_search_index = False
+            self.import_legacy_db(db, migrate=False)
+            return db
+        
+        uri = self.db_path.absolute().as_uri() + "?mode=ro"
+        db = sqlite3.connect(uri, uri=True)
+        try:
+            db.execute("SELECT 1 FROM packages LIMIT 0")
+        except sqlite3.OperationalError:
+            # A WAL database needs a writable -shm file or directory to be
+            # read; without either, fall back to reading it as immutable
+            db.close()
+            db = sqlite3.connect(uri + "&immutable=1", uri=True)
+        
+        try:
+            db.execute("SELECT 1 FROM package_search LIMIT 0")
+            self.has_search_index = True
+        except sqlite3.OperationalError:
+            self.has_search_index = False
+        return db
+    
+    def open_db(self):
+        """Open package database for writing, creating it if needed"""
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(self.db_path, 'w') as f:
-            json.dump(self.packages, f, indent=2)
+        db = sqlite3.connect(self.db_path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(_SCHEMA)
+        self.has_search_index = self.create_search_index(db)
+        self.import_legacy_db(db)
+        return db
+    
+    def create_search_index(self, db):
+        """Create the package search index, if this SQLite supports it"""
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'package_search'").fetchone()
+        try:
+            db.executescript(_SEARCH_SCHEMA)
+        except sqlite3.OperationalError:
+            # Built without FTS5, or older than 3.34 (no trigram tokenizer)
+            return False
+        
+        if not exists:
+            # Index packages recorded before the search table existed
+            with db:
+                db.execute("INSERT INTO package_search (package_search) VALUES ('rebuild')")
+        return True
+    
+    def import_legacy_db(self, db, migrate=True):
+        """Move packages from an old packages.json into the database
+        
+        Without migrate the file is only read, not renamed.
+        """
+        legacy_path = self.db_path.with_name(LEGACY_PACKAGE_DB)
+        if not legacy_path.exists():
+            return
+        
+        try:
+            packages = json.loads(legacy_path.read_bytes())
+        except json.JSONDecodeError:
+            packages = {}
+        if not isinstance(packages, dict):
+            # Valid JSON but not a package table; treat it as unreadable
+            packages = {}
+        
+        with db:
+            for name, info in packages.items():
+                self.record_package(db, name, info.get("version", "1.0.0"),
+                                    info.get("description", ""),
+                                    info.get("files", []))
+        if migrate:
+            legacy_path.rename(legacy_path.with_name(LEGACY_PACKAGE_DB + ".migrated"))
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """Group the database updates of several operations into one commit
+        
+        Operations that completed are committed even if the block is
+        interrupted, so the database keeps matching the files on disk.
+        """
+        if self.in_batch:
+            yield
+            return
+        
+        self.in_batch = True
+        # Open the transaction now so savepoints nest inside it
+        self.db.execute("BEGIN")
+        try:
+            yield
+        finally:
+            self.in_batch = False
+            # A failed or interrupted operation has already rolled back its own
+            # savepoint; commit the finished ones, whose file changes are on disk
+            self.db.commit()
+    
+    def transaction(self):
+        """Context for a single operation's updates; a savepoint inside batch()"""
+        return self.savepoint() if self.in_batch else self.db
+    
+    @contextlib.contextmanager
+    def savepoint(self):
+        """Roll back only this operation's updates if it fails"""
+        self.db.execute("SAVEPOINT op")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK TO op")
+            self.db.execute("RELEASE op")
+            raise
+        self.db.execute("RELEASE op")
+    
+    def record_package(self, db, name, version, description, files):
+        """Insert or replace a package and its file list"""
+        db.execute(
+            "INSERT INTO packages (name, version, description) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "version = excluded.version, description = excluded.description",
+            (name, version, description))
+        db.execute("DELETE FROM package_files WHERE pkg = ?", (name,))
+        db.executemany("INSERT OR IGNORE INTO package_files (pkg, path) VALUES (?, ?)",
+                       ((name, path) for path in files))
     
     def install(self, package_file):
         """Install a package"""
@@ -48,132 +286,210 @@ class PackageManager:
         
         print(f"Installing package: {pkg_path.name}")
         
-        # Create temporary extraction directory
-        extract_dir = self.cache_path / "tmp" / pkg_path.stem
-        if extract_dir.exists():
-            shutil.rmtree(extract_dir)
-        extract_dir.mkdir(parents=True, exist_ok=True)
+        # Only install needs these; keep list/search startup light
+        import tarfile
+        import zipfile
         
         try:
-            # Extract package
+            # Stream package entries straight to INSTALL_PREFIX
             if pkg_path.suffix == '.zip':
                 with zipfile.ZipFile(pkg_path, 'r') as zip_ref:
-                    zip_ref.extractall(extract_dir)
+                    entries = _zip_entries(zip_ref)
+                    # Serial: opening members is not thread-safe on a shared ZipFile,
+                    # and a ZipFile per thread re-parses the central directory
+                    manifest, installed_files = self.install_entries(
+                        pkg_path, entries, zip_ref.open)
             elif pkg_path.suffix in ['.tar', '.gz', '.tgz']:
-                with tarfile.open(pkg_path, 'r:*') as tar_ref:
-                    tar_ref.extractall(extract_dir)
+                # tarfile and its decompressors issue small reads; buffer them
+                with open(pkg_path, 'rb', buffering=COPY_BUFSIZE) as f, \
+                        tarfile.open(fileobj=f, mode='r:*') as tar_ref:
+                    entries = _tar_entries(tar_ref.getmembers())
+                    manifest, installed_files = self.install_entries(
+                        pkg_path, entries, tar_ref.extractfile)
             else:
-                # Assume raw directory or unknown format, just copy for now if it's a dir
+                # Assume raw directory or unknown format, install from it directly if it's a dir
                 if pkg_path.is_dir():
-                    shutil.copytree(pkg_path, extract_dir, dirs_exist_ok=True)
+                    entries = {}
+                    root_len = len(str(pkg_path)) + 1
+                    root_st = pkg_path.stat()
+                    # Directory symlinks are followed, as copytree did; each
+                    # directory carries the (st_dev, st_ino) of its ancestors so
+                    # a link back up the tree is not entered again
+                    stack = [(str(pkg_path), frozenset([(root_st.st_dev, root_st.st_ino)]))]
+                    while stack:
+                        dir_path, ancestors = stack.pop()
+                        with os.scandir(dir_path) as it:
+                            for entry in it:
+                                if entry.is_dir():
+                                    st = entry.stat()
+                                    dir_id = (st.st_dev, st.st_ino)
+                                    if dir_id in ancestors:
+                                        print(f"Warning: Skipping directory link loop: {entry.path}")
+                                    else:
+                                        stack.append((entry.path, ancestors | {dir_id}))
+                                elif entry.is_file():
+                                    rel_path = entry.path[root_len:]
+                                    if os.sep != "/":
+                                        rel_path = rel_path.replace(os.sep, "/")
+                                    st = entry.stat()
+                                    entries[rel_path] = (entry.path, st.st_mode, st.st_mtime)
+                    manifest, installed_files = self.install_entries(
+                        pkg_path, entries, lambda path: open(path, 'rb'), parallel=True)
                 else:
                     print(f"Error: Unsupported package format: {pkg_path.suffix}")
                     return False
-
-            # Read manifest
-            manifest_path = extract_dir / "manifest.json"
-            if not manifest_path.exists():
-                print("Error: Package missing manifest.json")
-                # Fallback: Create default manifest
-                manifest = {
-                    "name": pkg_path.stem,
-                    "version": "1.0.0",
-                    "description": "No description",
-                    "files": []
-                }
-            else:
-                with open(manifest_path) as f:
-                    manifest = json.load(f)
             
             pkg_name = manifest.get("name", pkg_path.stem)
             
-            # Install files
-            installed_files = []
-            content_dir = extract_dir / "content"
-            if not content_dir.exists():
-                # If no content dir, assume root of package is content
-                content_dir = extract_dir
-            
-            for root, dirs, files in os.walk(content_dir):
-                for file in files:
-                    if file == "manifest.json":
-                        continue
-                        
-                    src_file = Path(root) / file
-                    rel_path = src_file.relative_to(content_dir)
-                    dest_file = Path(INSTALL_PREFIX) / rel_path
-                    
-                    # Skip if it tries to overwrite system files (basic protection)
-                    if str(dest_file).startswith("/bin") or str(dest_file).startswith("/boot"):
-                        print(f"Warning: Skipping protected path: {dest_file}")
-                        continue
-
-                    dest_file.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(src_file, dest_file)
-                    installed_files.append(str(dest_file))
-                    print(f"  Installed: {rel_path}")
-            
             # Update database
-            self.packages[pkg_name] = {
-                "version": manifest.get("version", "1.0.0"),
-                "description": manifest.get("description", ""),
-                "installed": True,
-                "files": installed_files
-            }
-            
-            self.save_db()
+            with self.transaction():
+                self.record_package(self.db, pkg_name,
+                                    manifest.get("version", "1.0.0"),
+                                    manifest.get("description", ""),
+                                    installed_files)
             print(f"Successfully installed {pkg_name}")
             return True
             
         except Exception as e:
             print(f"Error installing package: {e}")
             return False
-        finally:
-            # Cleanup
-            if extract_dir.exists():
-                shutil.rmtree(extract_dir)
+    
+    def install_entries(self, pkg_path, entries, open_entry, parallel=False):
+        """Copy package entries into INSTALL_PREFIX
+        
+        entries maps archive paths to (key, mode, mtime); open_entry(key) returns a
+        binary file object. With parallel, open_entry must be safe to call
+        from several threads at once. Returns (manifest, installed_files).
+        """
+        entries = {posixpath.normpath(name): value for name, value in entries.items()}
+        
+        # Read manifest
+        if "manifest.json" not in entries:
+            print("Error: Package missing manifest.json")
+            # Fallback: Create default manifest
+            manifest = {
+                "name": pkg_path.stem,
+                "version": "1.0.0",
+                "description": "No description",
+                "files": []
+            }
+        else:
+            with open_entry(entries["manifest.json"][0]) as f:
+                manifest = json.load(f)
+        
+        # If no content dir, assume root of package is content
+        prefix = "content/" if any(name.startswith("content/") for name in entries) else ""
+        
+        # Collect destinations first so directories can be created up front
+        jobs = []
+        for name, (key, mode, mtime) in entries.items():
+            if not name.startswith(prefix) or posixpath.basename(name) == "manifest.json":
+                continue
+            
+            rel_path = name[len(prefix):]
+            if posixpath.isabs(rel_path) or rel_path.split("/", 1)[0] == "..":
+                print(f"Warning: Skipping unsafe path: {name}")
+                continue
+            dest_file = posixpath.join(INSTALL_PREFIX, rel_path)
+            
+            # Skip if it tries to overwrite system files (basic protection)
+            if dest_file.startswith(PROTECTED_PREFIXES):
+                print(f"Warning: Skipping protected path: {dest_file}")
+                continue
+
+            jobs.append((key, mode, mtime, rel_path, dest_file))
+        
+        # Sorted so parents come first; a directory whose parent is known only needs a mkdir
+        made = set()
+        for parent in sorted({posixpath.dirname(dest_file) for *_, dest_file in jobs}):
+            if posixpath.dirname(parent) in made:
+                try:
+                    os.mkdir(parent)
+                except FileExistsError:
+                    pass
+            else:
+                os.makedirs(parent, exist_ok=True)
+            while parent not in made:
+                made.add(parent)
+                parent = posixpath.dirname(parent)
+        
+        def install_file(job):
+            key, mode, mtime, rel_path, dest_file = job
+            with open_entry(key) as src, open(dest_file, 'wb') as dst:
+                _copy_stream(src, dst)
+            # Keep permission bits (e.g. executables); zips from non-Unix tools carry none.
+            # Like tarfile's data filter, drop setuid/setgid/sticky and group/other write.
+            if mode & 0o755:
+                os.chmod(dest_file, mode & 0o755)
+            # Keep the packaged modification time, as copy2 did
+            os.utime(dest_file, (mtime, mtime))
+            return rel_path, dest_file
+        
+        # Install files; copies are I/O bound, so threads overlap the syscalls
+        if parallel and len(jobs) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+                results = list(pool.map(install_file, jobs))
+        else:
+            results = [install_file(job) for job in jobs]
+        
+        installed_files = [dest_file for _, dest_file in results]
+        # One write for the whole listing rather than a flush per line
+        sys.stdout.write("".join(f"  Installed: {rel_path}\n" for rel_path, _ in results))
+        
+        return manifest, installed_files
     
     def uninstall(self, package_name):
         """Uninstall a package"""
-        if package_name not in self.packages:
+        row = self.db.execute("SELECT 1 FROM packages WHERE name = ?",
+                              (package_name,)).fetchone()
+        if row is None:
             print(f"Error: Package not installed: {package_name}")
             return False
         
         print(f"Uninstalling package: {package_name}")
         
         # Remove files
-        pkg_info = self.packages[package_name]
+        files = [path for (path,) in self.db.execute(
+            "SELECT path FROM package_files WHERE pkg = ?", (package_name,))]
         files_removed = 0
-        for file_path in pkg_info.get("files", []):
+        parents = set()
+        for file_path in files:
             try:
                 p = Path(file_path)
                 if p.exists():
                     p.unlink()
                     files_removed += 1
-                    # Try to remove empty parent directories
-                    try:
-                        p.parent.rmdir() 
-                    except OSError:
-                        pass # Directory not empty
+                    parents.add(os.path.dirname(file_path))
             except OSError as e:
                 print(f"Warning: Failed to remove {file_path}: {e}")
         
-        del self.packages[package_name]
-        self.save_db()
+        # Try to remove emptied parent directories, deepest first
+        for parent in sorted(parents, key=len, reverse=True):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                pass # Directory not empty
+        
+        with self.transaction():
+            self.db.execute("DELETE FROM package_files WHERE pkg = ?", (package_name,))
+            self.db.execute("DELETE FROM packages WHERE name = ?", (package_name,))
         print(f"Successfully uninstalled {package_name} ({files_removed} files removed)")
         return True
     
     def list_packages(self):
         """List installed packages"""
-        if not self.packages:
+        rows = self.db.execute(
+            "SELECT name, version, description FROM packages ORDER BY name").fetchall()
+        if not rows:
             print("No packages installed")
             return
         
         print(f"{'Name':<20} {'Version':<10} {'Description'}")
         print("-" * 60)
-        for name, info in self.packages.items():
-            version = info.get("version", "unknown")
-            desc = info.get("description", "")
+        for name, version, desc in rows:
+            version = version or "unknown"
+            desc = desc or ""
             print(f"{name:<20} {version:<10} {desc}")
     
     def search(self, query):
@@ -182,11 +498,24 @@ class PackageManager:
         print(f"Searching for: {query}")
         print("Repository search not yet implemented. Local matches:")
         
+        if self.has_search_index and len(query) >= 3:
+            # A quoted trigram MATCH is a case-insensitive substring search
+            rows = self.db.execute(
+                "SELECT name, description FROM package_search "
+                "WHERE package_search MATCH ? ORDER BY name",
+                ('"' + query.replace('"', '""') + '"',))
+        else:
+            # LIKE is case-insensitive for ASCII; escape its wildcards in the query
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            rows = self.db.execute(
+                "SELECT name, description FROM packages "
+                "WHERE name LIKE ?1 ESCAPE '\\' OR description LIKE ?1 ESCAPE '\\' "
+                "ORDER BY name", (pattern,))
+        
         found = False
-        for name, info in self.packages.items():
-            if query.lower() in name.lower() or query.lower() in info.get("description", "").lower():
-                print(f"  {name} - {info.get('description', '')}")
-                found = True
+        for name, desc in rows:
+            print(f"  {name} - {desc or ''}")
+            found = True
         
         if not found:
             print("  No local packages match.")
@@ -197,11 +526,13 @@ def main():
     
     # Install command
     install_parser = subparsers.add_parser("install", help="Install a package")
-    install_parser.add_argument("package", help="Package file to install")
+    install_parser.add_argument("packages", nargs="+", metavar="package",
+                                help="Package file(s) to install")
     
     # Uninstall command
     uninstall_parser = subparsers.add_parser("uninstall", help="Uninstall a package")
-    uninstall_parser.add_argument("package", help="Package name to uninstall")
+    uninstall_parser.add_argument("packages", nargs="+", metavar="package",
+                                  help="Package name(s) to uninstall")
     
     # List command
     list_parser = subparsers.add_parser("list", help="List installed packages")
@@ -216,12 +547,16 @@ def main():
         parser.print_help()
         return 1
     
-    pm = PackageManager()
+    pm = PackageManager(writable=args.command in ("install", "uninstall"))
     
     if args.command == "install":
-        return 0 if pm.install(args.package) else 1
+        with pm.batch():
+            results = [pm.install(package) for package in args.packages]
+        return 0 if all(results) else 1
     elif args.command == "uninstall":
-        return 0 if pm.uninstall(args.package) else 1
+        with pm.batch():
+            results = [pm.uninstall(package) for package in args.packages]
+        return 0 if all(results) else 1
     elif args.command == "list":
         pm.list_packages()
         return 0